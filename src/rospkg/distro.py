@@ -34,21 +34,47 @@
 Representation/model of rosdistro format.
 """
 
+import hashlib
 import os
+import pickle
 import re
-import string
+try:
+    from sys import intern
+except ImportError:
+    # builtin on Python 2
+    pass
 try:
     from urllib.request import urlopen
 except ImportError:
     from urllib2 import urlopen
 import yaml
+try:
+    from yaml import CSafeLoader as SafeLoader
+except ImportError:
+    from yaml import SafeLoader
 
+from . import __version__
 from .common import ResourceNotFound
 from .environment import get_etc_ros_dir
 
 TARBALL_URI_EVAL = 'http://svn.code.sf.net/p/ros-dry-releases/code/download/stacks/$STACK_NAME/$STACK_NAME-$STACK_VERSION/$STACK_NAME-$STACK_VERSION.tar.bz2'
 TARBALL_VERSION_EVAL = '$STACK_NAME-$STACK_VERSION'
 
+# set to disable caching of loaded distros, in memory and on disk
+ROSPKG_NO_CACHE = 'ROSPKG_NO_CACHE'
+# bump whenever the pickled layout of the distro classes changes.  The
+# package version is checked too, so releases never share entries.
+_DISTRO_CACHE_VERSION = 6
+# distros loaded by this process, ``{source_uri: (cache_key, Distro)}``
+_loaded_distros = {}
+
+_RULE_VAR_RE = re.compile(r'\$(STACK_NAME|STACK_VERSION|RELEASE_NAME)')
+# rules split into literal text and variable names, ``{rule: [str]}``.
+# Stacks usually share a few rule templates, so each is only scanned once.
+_rule_parts = {}
+_REVISION_RE = re.compile(r'\$Revision:\s*([0-9]*)\s*\$')
+_VERSION_RE = re.compile(r'[A-Za-z0-9.+~]*\Z')
+
 
 class InvalidDistro(Exception):
     """
@@ -67,17 +93,41 @@ def distro_uri(distro_name):
     """
     return "http://svn.code.sf.net/p/ros-dry-releases/code/trunk/distros/%s.rosdistro" % (distro_name)
 
+
+def _intern(value):
+    """
+    :returns: interned *value*, or *value* itself if it cannot be interned
+    """
+    try:
+        return intern(value)
+    except TypeError:
+        # None, or unicode on Python 2
+        return value
+
+
 def expand_rule(rule, stack_name, stack_ver, release_name):
-    s = rule.replace('$STACK_NAME', stack_name)
+    # literal rules, e.g. most dev-branch values, need no substitution
+    if '$' not in rule:
+        return rule
+    parts = _rule_parts.get(rule)
+    if parts is None:
+        # odd indices hold the variable names matched by the group
+        parts = _rule_parts[rule] = _RULE_VAR_RE.split(rule)
+    values = {'STACK_NAME': stack_name, 'RELEASE_NAME': release_name}
+    # $STACK_VERSION is left unexpanded for unreleased stacks
     if stack_ver:
-        s = s.replace('$STACK_VERSION', stack_ver)
-    s = s.replace('$RELEASE_NAME', release_name)
-    return s
+        values['STACK_VERSION'] = stack_ver
+    expanded = list(parts)
+    for i in range(1, len(parts), 2):
+        expanded[i] = values.get(parts[i], '$' + parts[i])
+    return ''.join(expanded)
 
 
 class DistroStack(object):
     """Stores information about a stack release"""
 
+    __slots__ = ('name', 'version', 'release_name', '_rules', 'repo', '_vcs_config', '_vcs_config_loaded')
+
     def __init__(self, stack_name, stack_version, release_name, rules):
         """
         :param stack_name: Name of stack
@@ -85,12 +135,28 @@ class DistroStack(object):
         :param release_name: name of distribution release.  Necessary for rule expansion.
         :param rules: raw '_rules' data.  Will be converted into appropriate vcs config instance.
         """
-        self.name = stack_name
-        self.version = stack_version
-        self.release_name = release_name
+        # names repeat across stacks and variants, share a single copy
+        self.name = _intern(stack_name)
+        self.version = _intern(stack_version)
+        self.release_name = _intern(release_name)
         self._rules = rules
         self.repo = rules.get('repo', None)
-        self.vcs_config = load_vcs_config(self._rules, self._expand_rule)
+        # expanding the rules is deferred until vcs_config is used, but
+        # malformed rules are still reported when the distro is loaded
+        _check_vcs_rules(rules)
+        self._vcs_config = None
+        # a flag rather than None, which is a valid vcs_config for unknown VCS types
+        self._vcs_config_loaded = False
+
+    @property
+    def vcs_config(self):
+        """
+        :class:`VcsConfig` instance representing the rules for this stack.
+        """
+        if not self._vcs_config_loaded:
+            self._vcs_config = load_vcs_config(self._rules, self._expand_rule)
+            self._vcs_config_loaded = True
+        return self._vcs_config
 
     def _expand_rule(self, rule):
         """
@@ -114,6 +180,8 @@ class Variant(object):
     another variant.
     """
 
+    __slots__ = ('name', 'extends', '_stack_names', '_stack_names_implicit')
+
     def __init__(self, variant_name, extends, stack_names, stack_names_implicit):
         """
         :param variant_name: name of variant to load from distro file, ``str``
@@ -141,19 +209,35 @@ class Distro(object):
     Store information in a rosdistro file.
     """
 
+    __slots__ = ('_stacks', 'variants', 'release_name', 'version', '_raw_data', '_released_stacks')
+
     def __init__(self, stacks, variants, release_name, version, raw_data):
         """
         :param stacks: dictionary mapping stack names to :class:`DistroStack` instances
         :param variants: dictionary mapping variant names to :class:`Variant` instances
         :param release_name: name of release, e.g. 'diamondback'
         :param version: version number of release
-        :param raw_data: raw dictionary representation of a distro
+        :param raw_data: raw dictionary representation of a distro, or
+          the YAML document it was parsed from
         """
         self._stacks = stacks
         self.variants = variants
         self.release_name = release_name
         self.version = version
-        self.raw_data = raw_data
+        self._raw_data = raw_data
+        # computed on first use, stacks are not modified after construction
+        self._released_stacks = None
+
+    @property
+    def raw_data(self):
+        """
+        Raw dictionary representation of the distro.  If the distro
+        was created from its YAML document, the document is parsed
+        again on each access.
+        """
+        if isinstance(self._raw_data, (bytes, str)):
+            return yaml.load(self._raw_data, Loader=SafeLoader)
+        return self._raw_data
 
     def get_stacks(self, released=False):
         """
@@ -167,11 +251,9 @@ class Distro(object):
             return self._stacks.copy()
 
     def _get_released_stacks(self):
-        retval = {}
-        for s, obj in self._stacks.items():
-            if obj.version:
-                retval[s] = obj
-        return retval
+        if self._released_stacks is None:
+            self._released_stacks = {s: obj for s, obj in self._stacks.items() if obj.version}
+        return self._released_stacks.copy()
 
     # gets map of all stacks
     stacks = property(get_stacks)
@@ -181,6 +263,12 @@ class Distro(object):
 
 def load_distro(source_uri):
     """
+    Parsed distro files are cached on disk, keyed on the file's
+    modification time and size (or the ETag/Last-Modified header for
+    remote files).  Repeated loads of an unchanged source within a
+    process return the same :class:`Distro` instance, which must not be
+    modified.  Set :envvar:`ROSPKG_NO_CACHE` to disable both caches.
+
     :param source_uri: source URI of distro file, or path to distro
       file.  Filename has precedence in resolution.
 
@@ -190,18 +278,36 @@ def load_distro(source_uri):
     try:
         # parse rosdistro yaml
         if os.path.isfile(source_uri):
-            # load rosdistro file
-            with open(source_uri) as f:
-                raw_data = yaml.safe_load(f.read())
+            stat = os.stat(source_uri)
+            cache_key = (os.path.abspath(source_uri), stat.st_mtime, stat.st_size)
+            distro = _read_distro_cache(cache_key)
+            if distro is not None:
+                return distro
+            # load rosdistro file.  The raw bytes go straight to the
+            # parser, which detects the encoding itself.
+            with open(source_uri, 'rb') as f:
+                document = f.read()
+            raw_data = yaml.load(document, Loader=SafeLoader)
         else:
             try:
                 request = urlopen(source_uri)
             except Exception as e:
                 raise ResourceNotFound('%s (%s)' % (str(e), source_uri))
             try:
-                raw_data = yaml.safe_load(request)
-            except ValueError:
-                raise ResourceNotFound(source_uri)
+                # remote files can only be cached if the server identifies the revision
+                headers = request.info()
+                stamp = headers.get('ETag') or headers.get('Last-Modified')
+                cache_key = (source_uri, stamp) if stamp else None
+                distro = _read_distro_cache(cache_key)
+                if distro is not None:
+                    return distro
+                try:
+                    document = request.read()
+                    raw_data = yaml.load(document, Loader=SafeLoader)
+                except ValueError:
+                    raise ResourceNotFound(source_uri)
+            finally:
+                request.close()
         if not type(raw_data) == dict:
             raise InvalidDistro("Distro must be a dictionary: %s" % (source_uri))
     except yaml.YAMLError as e:
@@ -212,9 +318,83 @@ def load_distro(source_uri):
         release_name = raw_data['release']
         stacks = _load_distro_stacks(raw_data, release_name)
         variants = _load_variants(raw_data.get('variants', {}), stacks)
-        return Distro(stacks, variants, release_name, version, raw_data)
+        # the parsed document is much larger than its text, which is
+        # all that needs to be kept for the rarely used raw_data
+        distro = Distro(stacks, variants, release_name, version, document)
     except KeyError as e:
         raise InvalidDistro("distro is missing required '%s' key" % (str(e)))
+    _write_distro_cache(cache_key, distro)
+    return distro
+
+
+def _get_distro_cache_path(cache_key):
+    """
+    :param cache_key: tuple of a distro source and its revision, or ``None``
+    :returns: path of the pickled distro for the source in *cache_key*,
+      or ``None`` if *cache_key* is ``None``, ``str``
+    """
+    if cache_key is None:
+        return None
+    cache_dir = os.environ.get('XDG_CACHE_HOME') or os.path.join(os.path.expanduser('~'), '.cache')
+    # one file per source, so a new revision replaces the previous entry
+    digest = hashlib.sha1(repr((cache_key[0], pickle.HIGHEST_PROTOCOL)).encode('utf-8')).hexdigest()
+    return os.path.join(cache_dir, 'rospkg', 'distro-%s.pkl' % digest)
+
+
+def _get_distro_cache_stamp(cache_key):
+    """
+    :returns: value stored with a pickled distro, which must match for
+      the entry to be used
+    """
+    return (__version__, _DISTRO_CACHE_VERSION) + cache_key
+
+
+def _read_distro_cache(cache_key):
+    """
+    :returns: cached :class:`Distro` for *cache_key*, or ``None`` on a miss
+    """
+    if cache_key is None or ROSPKG_NO_CACHE in os.environ:
+        return None
+    entry = _loaded_distros.get(cache_key[0])
+    if entry is not None and entry[0] == cache_key:
+        return entry[1]
+    path = _get_distro_cache_path(cache_key)
+    if path is None or not os.path.isfile(path):
+        return None
+    try:
+        with open(path, 'rb') as f:
+            stamp, distro = pickle.load(f)
+    except Exception:
+        # unreadable or stale entries are simply re-parsed
+        return None
+    if stamp != _get_distro_cache_stamp(cache_key) or not isinstance(distro, Distro):
+        return None
+    _loaded_distros[cache_key[0]] = (cache_key, distro)
+    return distro
+
+
+def _write_distro_cache(cache_key, distro):
+    if cache_key is None or ROSPKG_NO_CACHE in os.environ:
+        return
+    _loaded_distros[cache_key[0]] = (cache_key, distro)
+    path = _get_distro_cache_path(cache_key)
+    if path is None:
+        return
+    # write to a private file first so concurrent readers never see partial data
+    tmp_path = '%s.%d' % (path, os.getpid())
+    try:
+        cache_dir = os.path.dirname(path)
+        if not os.path.isdir(cache_dir):
+            os.makedirs(cache_dir)
+        with open(tmp_path, 'wb') as f:
+            pickle.dump((_get_distro_cache_stamp(cache_key), distro), f, pickle.HIGHEST_PROTOCOL)
+        os.rename(tmp_path, path)
+    except (IOError, OSError):
+        # the cache is only an optimization
+        try:
+            os.remove(tmp_path)
+        except OSError:
+            pass
 
 
 def _load_variants(raw_data, stacks):
@@ -222,13 +402,20 @@ def _load_variants(raw_data, stacks):
         return {}
     all_variants_raw_data = {}
     for v in raw_data:
-        if type(v) != dict or len(v.keys()) != 1:
+        if type(v) != dict or len(v) != 1:
             raise InvalidDistro("invalid variant spec: %s" % v)
-        variant_name = list(v.keys())[0]
+        variant_name = next(iter(v))
         all_variants_raw_data[variant_name] = v[variant_name]
+    extends = {}
+    for variant_name, variant_raw_data in all_variants_raw_data.items():
+        parents = variant_raw_data.get('extends', [])
+        if isinstance(parents, str):
+            parents = [parents]
+        extends[variant_name] = parents
     variants = {}
-    for variant_name in all_variants_raw_data.keys():
-        variants[variant_name] = _load_variant(variant_name, all_variants_raw_data)
+    for variant_name in _sort_variants(extends):
+        variants[variant_name] = _load_variant(variant_name, all_variants_raw_data[variant_name],
+                                               extends[variant_name], variants)
 
         # Disabling validation to support variants which include wet packages.
         # validate
@@ -238,16 +425,60 @@ def _load_variants(raw_data, stacks):
     return variants
 
 
-def _load_variant(variant_name, all_variants_raw_data):
-    variant_raw_data = all_variants_raw_data[variant_name]
-    stack_names_implicit = list(variant_raw_data.get('stacks', []))
-    extends = variant_raw_data.get('extends', [])
-    if isinstance(extends, str):
-        extends = [extends]
-    for e in extends:
-        parent_variant = _load_variant(e, all_variants_raw_data)
-        stack_names_implicit = parent_variant.get_stack_names(implicit=True) + stack_names_implicit
-    return Variant(variant_name, extends, variant_raw_data.get('stacks', []), stack_names_implicit)
+def _sort_variants(extends):
+    """
+    :param extends: names of the variants each variant extends, ``{str: [str]}``
+    :returns: variant names, with every variant listed after the
+      variants it extends, ``[str]``
+    :raises: :exc:`InvalidDistro` if a variant extends an unknown
+      variant or the variants extend each other in a cycle
+    """
+    order = []
+    # False while a variant's parents are being visited, True once it is in order
+    done = {}
+    for root in extends:
+        if root in done:
+            continue
+        done[root] = False
+        todo = [(root, iter(extends[root]))]
+        while todo:
+            variant_name, parents = todo[-1]
+            for parent in parents:
+                if parent not in extends:
+                    raise InvalidDistro("variant [%s] extends non-existent variant [%s]" % (variant_name, parent))
+                if parent not in done:
+                    done[parent] = False
+                    todo.append((parent, iter(extends[parent])))
+                    break
+                if not done[parent]:
+                    raise InvalidDistro("variant [%s] extends itself through [%s]" % (parent, variant_name))
+            else:
+                todo.pop()
+                done[variant_name] = True
+                order.append(variant_name)
+    return order
+
+
+def _load_variant(variant_name, variant_raw_data, extends, variants):
+    """
+    :param variant_raw_data: raw rosdistro data for this variant, ``dict``
+    :param extends: names of the variants this variant extends, ``[str]``
+    :param variants: loaded variants, which must include all variants
+      in *extends*, ``{str: Variant}``
+    """
+    stack_names = variant_raw_data.get('stacks', [])
+    # later parents come first, followed by this variant's own stacks.
+    # Stacks shared by several parents are only listed once.
+    chunks = [variants[e].get_stack_names(implicit=True) for e in reversed(extends)]
+    chunks.append(stack_names)
+    stack_names_implicit = []
+    seen = set()
+    for chunk in chunks:
+        for stack_name in chunk:
+            if stack_name not in seen:
+                seen.add(stack_name)
+                stack_names_implicit.append(_intern(stack_name))
+    return Variant(variant_name, extends, stack_names, stack_names_implicit)
 
 
 def _load_distro_stacks(distro_doc, release_name):
@@ -262,11 +493,14 @@ def _load_distro_stacks(distro_doc, release_name):
     try:
         stack_props = distro_doc['stacks']
         stack_props = stack_props or {}
-        stack_names = [x for x in stack_props.keys() if not x[0] == '_']
     except KeyError:
         raise InvalidDistro("distro is missing required 'stacks' key")
-    for stack_name in stack_names:
-        stack_version = stack_props[stack_name].get('version', None)
+    for stack_name, props in stack_props.items():
+        # skip '_rules' and other private keys
+        if stack_name[0] == '_':
+            continue
+        stack_version = props.get('version', None)
+        stack_name = _intern(stack_name)
         rules = _get_rules(distro_doc, stack_name)
         if not rules:
             raise InvalidDistro("no VCS rules for stack [%s]" % (stack_name))
@@ -282,13 +516,12 @@ def _distro_version(version_val):
     # check for no keyword sub
     if version_val == '$Revision$':
         return 0
-    m = re.search(r'\$Revision:\s*([0-9]*)\s*\$', version_val)
+    m = _REVISION_RE.search(version_val)
     if m is not None:
         version_val = 'r' + m.group(1)
 
     # Check that is a valid version string
-    valid = string.ascii_letters + string.digits + '.+~'
-    if False in (c in valid for c in version_val):
+    if not _VERSION_RE.match(version_val):
         raise InvalidDistro("Version string %s not valid" % version_val)
     return version_val
 
@@ -309,11 +542,13 @@ def distro_to_rosinstall(distro, branch, variant_name=None, implicit=True, relea
         stack_names = set(variant.get_stack_names(implicit=implicit))
     else:
         stack_names = distro.released_stacks.keys()
+    stacks = distro.stacks
+    released_stacks = distro.released_stacks
     rosinstall_data = []
     for s in stack_names:
-        if released_only and s not in distro.released_stacks:
+        if released_only and s not in released_stacks:
             continue
-        rosinstall_data.extend(distro.stacks[s].vcs_config.to_rosinstall(s, branch, anonymous))
+        rosinstall_data.extend(stacks[s].vcs_config.to_rosinstall(s, branch, anonymous))
     return rosinstall_data
 
 ################################################################################
@@ -358,6 +593,17 @@ class VcsConfig(object):
     Base representation of a rosdistro VCS rules configuration.
     """
 
+    # keys that the rules for this VCS type must define
+    required_keys = ()
+
+    @classmethod
+    def get_required_keys(cls, rules):
+        """
+        :param rules: raw rosdistro rules entry, ``dict``
+        :returns: keys that :meth:`load` reads from *rules*, ``(str)``
+        """
+        return cls.required_keys
+
     def __init__(self, type_):
         self.type = type_
         self.tarball_url = self.tarball_version = None
@@ -411,6 +657,8 @@ class DvcsConfig(VcsConfig):
      * ``release_tag``: a tag of the code for a specific release
     """
 
+    required_keys = ('uri', 'dev-branch', 'distro-tag', 'release-tag')
+
     def __init__(self, type_):
         super(DvcsConfig, self).__init__(type_)
         self.repo_uri = self.anon_repo_uri = None
@@ -497,6 +745,16 @@ class SvnConfig(VcsConfig):
      * ``release_tag``: a tag of the code for a specific release
     """
 
+    required_keys = ('dev', 'distro-tag', 'release-tag')
+    # anonymous URLs are optional, but must be given as a complete set
+    anon_keys = ('anon-dev', 'anon-distro-tag', 'anon-release-tag')
+
+    @classmethod
+    def get_required_keys(cls, rules):
+        if 'anon-dev' in rules:
+            return cls.required_keys + cls.anon_keys
+        return cls.required_keys
+
     def __init__(self):
         super(SvnConfig, self).__init__('svn')
         self.dev = None
@@ -513,7 +771,7 @@ class SvnConfig(VcsConfig):
 
     def load(self, rules, rule_eval):
         super(SvnConfig, self).load(rules, rule_eval)
-        for k in ['dev', 'distro-tag', 'release-tag']:
+        for k in self.get_required_keys(rules):
             if k not in rules:
                 raise KeyError("svn rules missing required %s key: %s" % (k, rules))
         self.dev = rule_eval(rules['dev'])
@@ -597,6 +855,22 @@ def load_vcs_config(rules, rule_eval):
     return vcs_config
 
 
+def _check_vcs_rules(rules):
+    """
+    Check that rosdistro _rules data defines the keys required by its
+    VCS type, without creating the :class:`VcsConfig`.
+
+    :param rules: rosdistro rules data
+    :raises: :exc:`KeyError` If a required key is missing
+    """
+    for k, clazz in _vcs_configs.items():
+        if k in rules:
+            for key in clazz.get_required_keys(rules[k]):
+                if key not in rules[k]:
+                    raise KeyError("%s rules missing required %s key: %s" % (k, key, rules[k]))
+            break
+
+
 def _current_distro_electric_parse_roscore(roscore_file):
     if not os.path.exists(roscore_file):
         return None
@@ -31,9 +31,41 @@
 # POSSIBILITY OF SUCH DAMAGE.
 
 import os
+import shutil
+import tempfile
 
 import yaml
 
+try:
+    from unittest.mock import patch
+except ImportError:
+    from mock import patch
+try:
+    from urllib.request import pathname2url, urlopen
+except ImportError:
+    from urllib import pathname2url
+    from urllib2 import urlopen
+
+
+_cache_home = None
+_old_cache_home = None
+
+
+def setup_module():
+    # keep load_distro() from writing to the user's cache directory
+    global _cache_home, _old_cache_home
+    _old_cache_home = os.environ.get('XDG_CACHE_HOME')
+    _cache_home = tempfile.mkdtemp()
+    os.environ['XDG_CACHE_HOME'] = _cache_home
+
+
+def teardown_module():
+    if _old_cache_home is None:
+        os.environ.pop('XDG_CACHE_HOME', None)
+    else:
+        os.environ['XDG_CACHE_HOME'] = _old_cache_home
+    shutil.rmtree(_cache_home)
+
 
 def get_test_path():
     return os.path.abspath(os.path.join(os.path.dirname(__file__), 'rosdistro'))
@@ -156,6 +188,22 @@ def test_expand_rule():
     assert 'version' == expand_rule('$STACK_VERSION', 'foo', 'version', 'release')
     assert 'release' == expand_rule('$RELEASE_NAME', 'foo', 'version', 'release')
     assert 'foo-version-release' == expand_rule('$STACK_NAME-$STACK_VERSION-$RELEASE_NAME', 'foo', 'version', 'release')
+    assert 'master' == expand_rule('master', 'foo', 'version', 'release')
+    assert 'foo-$STACK_VERSION-release' == expand_rule('$STACK_NAME-$STACK_VERSION-$RELEASE_NAME', 'foo', None, 'release')
+
+
+def test__distro_version():
+    from rospkg.distro import _distro_version, InvalidDistro
+    assert 0 == _distro_version('$Revision$')
+    assert 'r8596' == _distro_version('$Revision: 8596 $')
+    assert '1' == _distro_version(1)
+    assert '1.0+deb~1' == _distro_version('1.0+deb~1')
+    for bad in ['1.0 beta', '1-2', '$Revision: abc $']:
+        try:
+            _distro_version(bad)
+            assert False, "should have raised: %s" % (bad)
+        except InvalidDistro:
+            pass
 
 
 default_rules = {}
@@ -173,7 +221,10 @@ def test_DistroStack():
     assert 'stack' == s.name
     assert 'version' == s.version
     assert rule == s._rules
+    # vcs_config is created on first access
+    assert not s._vcs_config_loaded
     assert 'git' == s.vcs_config.type
+    assert s.vcs_config is s.vcs_config
     assert s.vcs_config.get_branch('devel', False) == ('git@github.com:ipa320/stack.git', 'release_electric')
     assert s.vcs_config.get_branch('devel', True) == ('https://github.com/ipa320/stack.git', 'release_electric')
     assert s.vcs_config.get_branch('distro', False) == ('git@github.com:ipa320/stack.git', 'electric'), s.vcs_config.get_branch('release', False)
@@ -191,6 +242,26 @@ def test_DistroStack():
     rule2['git']['uri'] == 'foo'
     assert s != DistroStack('stack', 'version', 'dback', rule2)
 
+    # rules without a known VCS have no vcs_config, which is only looked up once
+    s_no_vcs = DistroStack('stack', 'version', 'electric', {'repo': 'x'})
+    with patch('rospkg.distro.load_vcs_config', return_value=None) as load_vcs_config:
+        assert s_no_vcs.vcs_config is None
+        assert s_no_vcs.vcs_config is None
+    assert load_vcs_config.call_count == 1
+
+    # rules are checked eagerly even though they are expanded lazily
+    svn_rule = {'dev': 'dev', 'distro-tag': 'distro', 'release-tag': 'release'}
+    partial_anon_rule = dict(svn_rule, **{'anon-dev': 'anon-dev'})
+    full_anon_rule = dict(partial_anon_rule, **{'anon-distro-tag': 'anon-distro', 'anon-release-tag': 'anon-release'})
+    DistroStack('stack', 'version', 'electric', {'svn': full_anon_rule})
+    for bad_rule in [{'git': {'uri': 'git@github.com:ipa320/$STACK_NAME.git'}},
+                     {'svn': partial_anon_rule}]:
+        try:
+            DistroStack('stack', 'version', 'electric', bad_rule)
+            assert False, "should have raised: %s" % (bad_rule)
+        except KeyError:
+            pass
+
 
 def test_Variant():
     from rospkg.distro import Variant
@@ -235,6 +306,9 @@ def test_Distro():
     assert {'stack': s} == d.get_stacks(released=True)
     assert stacks == d.stacks
     assert {'stack': s} == d.released_stacks
+    # callers get their own copy of the memoized dict
+    d.released_stacks.clear()
+    assert {'stack': s} == d.released_stacks
 
 
 dback_ros_rules = {'svn': {'dev': 'https://code.ros.org/svn/ros/stacks/$STACK_NAME/trunk',
@@ -263,7 +337,7 @@ def test_load_distro_bad_data():
         assert False
     except ResourceNotFound:
         pass
-    for i in range(1, 10):
+    for i in range(1, 11):
         if i == 4:
             # currently non-existent stacks in variants are not determinable
             continue
@@ -348,6 +422,85 @@ def test_load_distro_diamondback():
     assert distro.stacks['common'].vcs_config.get_branch('devel', True) == ('https://code.ros.org/svn/ros-pkg/stacks/common/trunk', None)
 
 
+def test_load_distro_cache():
+    import rospkg.distro
+    from rospkg.distro import load_distro, Distro, ROSPKG_NO_CACHE
+    p = os.path.join(get_test_path(), 'simple.rosdistro')
+    cache_home = tempfile.mkdtemp()
+    old_env = os.environ.copy()
+    try:
+        os.environ['XDG_CACHE_HOME'] = cache_home
+        os.environ.pop(ROSPKG_NO_CACHE, None)
+        cache_dir = os.path.join(cache_home, 'rospkg')
+        rospkg.distro._loaded_distros.clear()
+        distro = load_distro(p)
+        assert len(os.listdir(cache_dir)) == 1, os.listdir(cache_dir)
+        assert load_distro(p) is distro
+
+        rospkg.distro._loaded_distros.clear()
+        cached = load_distro(p)
+        assert cached is not distro
+        assert isinstance(cached, Distro)
+        assert cached.release_name == distro.release_name
+        assert cached.raw_data == distro.raw_data
+        assert cached.stacks == distro.stacks
+
+        # a new revision of a file replaces its cache entry
+        copy = os.path.join(cache_home, 'copy.rosdistro')
+        shutil.copy(p, copy)
+        load_distro(copy)
+        assert len(os.listdir(cache_dir)) == 2, os.listdir(cache_dir)
+        mtime = os.stat(copy).st_mtime + 10
+        os.utime(copy, (mtime, mtime))
+        rospkg.distro._loaded_distros.clear()
+        load_distro(copy)
+        assert len(os.listdir(cache_dir)) == 2, os.listdir(cache_dir)
+
+        rospkg.distro._loaded_distros.clear()
+        shutil.rmtree(cache_dir)
+        os.environ[ROSPKG_NO_CACHE] = '1'
+        distro = load_distro(p)
+        assert not os.path.exists(cache_dir)
+        assert load_distro(p) is not distro
+        del os.environ[ROSPKG_NO_CACHE]
+
+        # relative and absolute paths share an entry
+        rospkg.distro._loaded_distros.clear()
+        distro = load_distro(p)
+        cwd = os.getcwd()
+        try:
+            os.chdir(get_test_path())
+            assert load_distro('simple.rosdistro') is distro
+        finally:
+            os.chdir(cwd)
+        assert len(os.listdir(cache_dir)) == 1, os.listdir(cache_dir)
+    finally:
+        os.environ.clear()
+        os.environ.update(old_env)
+        shutil.rmtree(cache_home)
+
+
+def test_load_distro_url_closed():
+    import rospkg.distro
+    from rospkg.distro import load_distro
+    p = os.path.join(get_test_path(), 'simple.rosdistro')
+    uri = 'file://' + pathname2url(p)
+    responses = []
+
+    def urlopen_recorder(source_uri):
+        response = urlopen(source_uri)
+        responses.append(response)
+        return response
+    rospkg.distro._loaded_distros.clear()
+    with patch('rospkg.distro.urlopen', urlopen_recorder):
+        distro = load_distro(uri)
+        # second load is served from the cache
+        assert load_distro(uri) is distro
+    assert len(responses) == 2
+    for response in responses:
+        assert response.fp.closed
+
+
 def test__load_variants():
     from rospkg.distro import _load_variants
     raw_data = yaml.safe_load("""variants:
@@ -382,9 +535,34 @@ def test__load_variants():
     assert set(variants['ros-full'].get_stack_names(False)) == set(['rx', 'documentation'])
 
     assert set(variants['desktop'].get_stack_names(True)) == set(stacks.keys())
+    # ros-base is reached through both robot and ros-full
+    assert len(variants['desktop'].get_stack_names(True)) == len(stacks)
     assert set(variants['desktop'].get_stack_names(False)) == set(['ros_tutorials', 'common_tutorials'])
 
 
+def test__load_variants_invalid_extends():
+    from rospkg.distro import _load_variants, InvalidDistro
+    for spec in ["""variants:
+- base:
+    extends: missing
+    stacks: [ros]
+""", """variants:
+- base:
+    extends: top
+    stacks: [ros]
+- middle:
+    extends: base
+- top:
+    extends: [middle]
+"""]:
+        raw_data = yaml.safe_load(spec)['variants']
+        try:
+            _load_variants(raw_data, {})
+            assert False, "should have raised: %s" % (spec)
+        except InvalidDistro:
+            pass
+
+
 diamondback_stacks = [
     'pr2_web_apps', 'octomap_mapping', 'motion_planning_environment', 'robot_calibration',
     'sound_drivers', 'joystick_drivers', 'ros',